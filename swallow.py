@@ -1,6 +1,7 @@
 """Driver for Swallow weather station"""
 
 from __future__ import with_statement
+import binascii
 import serial
 import syslog
 import time
@@ -12,16 +13,23 @@ DRIVER_VERSION = '1.0'
 DEFAULT_PORT = 'ttyUSB0'
 BAUDRATE = 9600
 DEBUG_READ = 0
+MAX_TRIES = 5
+RETRY_WAIT = 5.0
 PACKET_BYTE_COUNT = 49
-BASE = 16
-DATA_START_INDEX = 2
-DATA_END_INDEX = -5
+DATA_START_INDEX = 5
+CRC_INDEX = 47
+
+# little-endian payload following the 5 byte header, up to the checksum
+_PACKET = struct.Struct('<HfffffIfffI')
+_CRC = struct.Struct('<H')
 
 def loader(config_dict, _):
     return SwallowDriver(**config_dict[DRIVER_NAME])
 
 def logmsg(level, msg):
-    syslog.syslog(level, 'swallow: %s' % msg)
+    # setlogmask(0) reads the current mask without changing it
+    if syslog.setlogmask(0) & syslog.LOG_MASK(level):
+        syslog.syslog(level, 'swallow: %s' % msg)
 
 def logdbg(msg):
     logmsg(syslog.LOG_DEBUG, msg)
@@ -37,6 +45,8 @@ class SwallowDriver(weewx.drivers.AbstractDevice):
     def __init__(self, **stn_dict):
         self.port = stn_dict.get('port', DEFAULT_PORT)
         self.loop_interval = float(stn_dict.get('loop_interval', 60.0))
+        self.max_tries = int(stn_dict.get('max_tries', MAX_TRIES))
+        self.retry_wait = float(stn_dict.get('retry_wait', RETRY_WAIT))
         loginf('driver version is %s ' % DRIVER_VERSION)
         loginf('using serial port %s ' % self.port)
 
@@ -52,26 +62,41 @@ class SwallowDriver(weewx.drivers.AbstractDevice):
 
     @property
     def hardware_name(self):
-        return 'Swallow'
+        return DRIVER_NAME
 
     def genLoopPackets(self):
+        deadline = time.monotonic()
+        failures = 0
         while True:
-            readings = None
-            while True:
-                packet = {'dateTime': int(time.time() + 0.5),
-                          'usUnits': weewx.METRIC}
+            try:
                 readings = self.station.get_readings()
-                readings.reverse()
-                if self.station.verify_readings(readings) == True:
-                    break;
-            data = self.station.parse_readings(readings[DATA_START_INDEX:DATA_END_INDEX])
-            Station.print_data(data)
-            packet.update(data)
-            time.sleep(self.loop_interval)
-            yield packet
+                verified = self.station.verify_readings(readings)
+            except weewx.WeeWxIOError as e:
+                logerr('read failed: %s' % e)
+                verified = False
+            if verified:
+                failures = 0
+                packet = self.station.parse_readings(readings)
+                if DEBUG_READ:
+                    Station.print_data(packet)
+                packet['dateTime'] = int(time.time() + 0.5)
+                packet['usUnits'] = weewx.METRIC
+                yield packet
+                deadline += self.loop_interval
+                now = time.monotonic()
+                if deadline > now:
+                    time.sleep(deadline - now)
+                else:
+                    deadline = now
+            else:
+                failures += 1
+                if failures >= self.max_tries:
+                    raise weewx.WeeWxIOError('%d bad packets in a row' % failures)
+                time.sleep(self.retry_wait)
 
 class Station(object):
     REQUEST = b'\xAA\xBB\x00\x02\x2A\x6E\xFE'
+    REPLY_HEADER = b'\xCC\xDD\x00\x02\x2A'
     MAX_HUMI = 100.0
     MIN_HUMI = 0.0
     def __init__(self, port):
@@ -100,51 +125,63 @@ class Station(object):
             self.serial_port = None
 
     def get_readings(self):
-        data_left = 0
-        while data_left < PACKET_BYTE_COUNT:
-            self.serial_port.flushInput()
-            self.serial_port.write(Station.REQUEST)
-            time.sleep(10)
-            data_left = self.serial_port.inWaiting()
-        
+        # the station only answers requests, so anything already buffered
+        # is a stale reply and must not be mistaken for this one
+        self.serial_port.reset_input_buffer()
+        self.serial_port.write(Station.REQUEST)
         received_bytes = self.serial_port.read(PACKET_BYTE_COUNT)
-        loginf('SUCCESS: GET READINGS')
-        return [str(val) for val in received_bytes]
-
-    def verify_readings(self, readings):
-        data = 0xFFFF - sum([Station.hex_to_int(val) for val in readings[DATA_START_INDEX:]])
-        crc = Station.hex_to_int(''.join(readings[0:DATA_START_INDEX]))
+        start = received_bytes.find(Station.REPLY_HEADER)
+        if start > 0:
+            # line noise ahead of the reply, realign on its header
+            received_bytes = received_bytes[start:] + self.serial_port.read(start)
+        if DEBUG_READ:
+            loginf('packet: %s' % binascii.hexlify(received_bytes).decode('ascii'))
+        if len(received_bytes) != PACKET_BYTE_COUNT:
+            raise weewx.WeeWxIOError('expected %d bytes, got %d' %
+                                     (PACKET_BYTE_COUNT, len(received_bytes)))
+        if DEBUG_READ:
+            loginf('SUCCESS: GET READINGS')
+        return received_bytes
+
+    def verify_readings(self, packet):
+        if not packet.startswith(Station.REPLY_HEADER):
+            loginf('FAILED: VERIFY HEADER')
+            return False
+        data = (0xFFFF - sum(memoryview(packet)[:CRC_INDEX])) & 0xFFFF
+        crc = _CRC.unpack_from(packet, CRC_INDEX)[0]
         if crc == data:
-            loginf('SUCCESS: VERIFY READINGS')
+            if DEBUG_READ:
+                loginf('SUCCESS: VERIFY READINGS')
             return True
         loginf('FAILED: VERIFY READINGS')
         return False
 
-    def parse_readings(self, raw):
-        data = dict()
-
-        data['windDir'] = Station.hex_to_int(''.join(raw[40:42]))
-        data['outTemp'] = self.get_verifyed_outtemp(Station.hex_to_float(''.join(raw[36:40])))
-        data['pressure'] = Station.hex_to_float(''.join(raw[32:36]))
-        data['long_term_rain'] = Station.hex_to_float(''.join(raw[28:32]))
-        data['windSpeed'] = Station.hex_to_float(''.join(raw[24:28]))
-        data['outHumidity'] = Station.get_humi(Station.hex_to_float(''.join(raw[20:24])))
-        data['long_term_geiger'] = Station.hex_to_int(''.join(raw[16:20]))
-        data['illumination'] = Station.hex_to_float(''.join(raw[12:16]))
-        data['inTemp'] = Station.hex_to_float(''.join(raw[8:12]))
-        data['maxWind'] = Station.hex_to_float(''.join(raw[4:8]))
-        data['downfall'] = bool(Station.hex_to_int(''.join(raw[0:4])))
-        data['deltarain'] = self.get_delta_rain(data['long_term_rain'])
-        data['geiger'] = self.get_delta_geiger(data['long_term_geiger'])
-        return data
-
-    @staticmethod
-    def hex_to_float(val):
-        return round(struct.unpack('!f', val)[0], 1)
-
-    @staticmethod
-    def hex_to_int(val):
-        return int(val.encode('hex'), BASE)
+    def parse_readings(self, packet):
+        (wind_dir, out_temp, pressure, long_term_rain, wind_speed, humidity,
+         long_term_geiger, illumination, in_temp, max_wind,
+         downfall) = _PACKET.unpack_from(packet, DATA_START_INDEX)
+        long_term_rain = round(long_term_rain, 1)
+        delta_rain = 0.0
+        if self.last_rain and long_term_rain > self.last_rain:
+            delta_rain = round(long_term_rain - self.last_rain, 1)
+        self.last_rain = long_term_rain
+        delta_geiger = 0
+        if self.last_geiger and long_term_geiger > self.last_geiger:
+            delta_geiger = long_term_geiger - self.last_geiger
+        self.last_geiger = long_term_geiger
+        return {'windDir': wind_dir,
+                'outTemp': self.get_verifyed_outtemp(round(out_temp, 1)),
+                'pressure': round(pressure, 1),
+                'long_term_rain': long_term_rain,
+                'windSpeed': round(wind_speed, 1),
+                'outHumidity': Station.get_humi(round(humidity, 1)),
+                'long_term_geiger': long_term_geiger,
+                'illumination': round(illumination, 1),
+                'inTemp': round(in_temp, 1),
+                'maxWind': round(max_wind, 1),
+                'downfall': bool(downfall),
+                'deltarain': delta_rain,
+                'geiger': delta_geiger}
 
     @staticmethod
     def get_humi(val):
@@ -154,25 +191,10 @@ class Station(object):
 
     @staticmethod
     def print_data(data):
-        for k,v in data.items():
-            loginf('{0}: {1}'.format(k,v))
-
-    def get_delta_rain(self, longterm):
-        delta = 0.0
-        if (self.last_rain != 0.0) and (longterm > self.last_rain):
-            delta = longterm - self.last_rain
-        self.last_rain = longterm
-        return round(delta, 1)
-
-    def get_delta_geiger(self, longterm):
-        delta = 0
-        if (self.last_geiger != 0) and (longterm > self.last_geiger):
-            delta = longterm - self.last_geiger
-        self.last_geiger = longterm
-        return delta
+        loginf('data: %s' % ' '.join('%s=%s' % kv for kv in data.items()))
 
     def get_verifyed_outtemp(self, temp):
-        if (self.last_outtemp == None) or (abs(self.last_outtemp - temp) < 5.0):
+        if self.last_outtemp is None or abs(self.last_outtemp - temp) < 5.0:
             self.last_outtemp = temp
             return temp
         else: